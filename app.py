@@ -1,16 +1,25 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, send_file
+from flask import Flask, g, render_template, stream_template, request, jsonify, redirect, url_for, flash, send_file
+from flask.json.provider import DefaultJSONProvider
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 import sqlite3
 from datetime import datetime, timedelta
-import qrcode
+import segno
 import io
 import base64
-import json
+import orjson
 import os
 import re
 import secrets
 import csv
+import time
+import queue
+import threading
+import atexit
+from collections import OrderedDict
+from contextlib import closing
 from functools import wraps
 
 app = Flask(__name__)
@@ -20,191 +29,736 @@ app.config['SESSION_COOKIE_SECURE'] = True
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that encodes and decodes with orjson"""
+    # Datetimes are passed to default() so they keep Flask's HTTP date format
+    options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.options).decode()
+    
+    def loads(self, s, **kwargs):
+        # orjson has no object_hook, which the session serializer relies on
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self.options)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+app.json = OrjsonProvider(app)
+
 # Flask-Login setup
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
 class User(UserMixin):
-    def __init__(self, id, username, role='user'):
+    def __init__(self, id, username, role='user', kra_pin=None, business_name=None):
         self.id = id
         self.username = username
         self.role = role
+        self.kra_pin = kra_pin
+        self.business_name = business_name
+
+# Argon2id for new password hashes; older Werkzeug hashes are upgraded on login
+password_hasher = PasswordHasher(time_cost=2, memory_cost=65536, parallelism=1)
+
+# Login rate limiting: failed attempts per IP within a window, in seconds
+LOGIN_ATTEMPT_WINDOW = 300
+LOGIN_ATTEMPT_LIMIT = 5
+
+# Receipt columns for listings and JSON; leaves out the stored QR image
+RECEIPT_COLUMNS = ('id, receipt_number, user_id, subtotal, vat_amount, total_amount, '
+                   'customer_name, customer_pin, payment_method, created_at')
+
+# Everything the views read from a user row; password_hash is left to login
+USER_COLUMNS = ('id, business_name, kra_pin, phone_number, person_in_charge, town_city, '
+                'username, role, is_active, api_key, receipt_prefix, vat_rate, '
+                'include_address, auto_print, created_at')
+
+# SQL for the hot paths, kept as constants so each connection's
+# statement cache reuses the prepared statements
+SQL_USER_BY_ID = f'SELECT {USER_COLUMNS} FROM users WHERE id = ?'
+
+SQL_RECEIPT_BY_ID = f'SELECT {RECEIPT_COLUMNS} FROM receipts WHERE id = ? AND user_id = ?'
+
+SQL_RECEIPT_QR = '''
+    SELECT receipt_number, subtotal, total_amount, vat_amount, created_at, qr_png
+    FROM receipts WHERE id = ? AND user_id = ?
+'''
+
+SQL_RECEIPT_ITEMS = '''
+    SELECT id, receipt_id, product_name, quantity, unit_price, total_price
+    FROM receipt_items WHERE receipt_id = ?
+'''
+
+SQL_INSERT_RECEIPT = '''
+    INSERT INTO receipts (receipt_number, user_id, subtotal, vat_amount, total_amount,
+                          customer_name, customer_pin, payment_method, qr_png)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+SQL_INSERT_RECEIPT_ITEMS = '''
+    INSERT INTO receipt_items (receipt_id, product_name, quantity, unit_price, total_price)
+    VALUES {}
+'''
+
+# SQLite's bound parameter limit is 999 on older builds; 500 leaves headroom
+MAX_SQL_BINDINGS = 500
+
+SQL_UPDATE_USER_ROLE = 'UPDATE users SET role = ? WHERE id = ?'
 
-# Store login attempts for rate limiting
-login_attempts = {}
+SQL_UPDATE_USER_ACTIVE = 'UPDATE users SET is_active = ? WHERE id = ?'
+
+SQL_UPDATE_USER_ROLE_ACTIVE = 'UPDATE users SET role = ?, is_active = ? WHERE id = ?'
+
+SQL_DASHBOARD = '''
+    SELECT
+        (SELECT json_object('count', COUNT(*),
+                            'total_sales', COALESCE(SUM(total_amount), 0),
+                            'total_vat', COALESCE(SUM(vat_amount), 0))
+         FROM receipts
+         WHERE user_id = ? AND created_at >= ? AND created_at < ?) AS stats,
+        (SELECT json_group_array(json_object('id', id,
+                                             'receipt_number', receipt_number,
+                                             'customer_name', customer_name,
+                                             'total_amount', total_amount,
+                                             'vat_amount', vat_amount,
+                                             'payment_method', payment_method,
+                                             'created_at', created_at))
+         FROM (SELECT id, receipt_number, customer_name, total_amount,
+                      vat_amount, payment_method, created_at
+               FROM receipts
+               WHERE user_id = ?
+               ORDER BY created_at DESC, id DESC
+               LIMIT 5)) AS recent
+'''
+
+KRA_PIN_PATTERN = re.compile(r'^[A-Z]\d{9}[A-Z]$')
+
+# UPDATE/INSERT ... RETURNING needs SQLite 3.35
+SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Databases already switched to WAL by this process
+wal_databases = set()
+
+# Idle connections kept open between requests, per database path; reusing
+# them keeps their page and statement caches warm
+db_pools = {}
+DB_POOL_SIZE = 8
+
+# Seconds a connection waits for another's write lock before failing
+DB_BUSY_TIMEOUT = 5.0
+
+# Receipt number stems, keyed by user id and receipt prefix
+receipt_stems = {}
+
+# Short-lived receipt counts for the listing page, per user and keyed by
+# filters; each user's entries are kept oldest first and capped
+receipt_count_cache = {}
+receipt_count_lock = threading.Lock()
+RECEIPT_COUNT_TTL = 30
+RECEIPT_COUNT_CACHE_SIZE = 64
+
+# Partial backups older than this are left over from an interrupted copy
+BACKUP_STALE_AGE = 600
+
+# Audit entries are queued by requests and written in batches by a background
+# thread; the queue is bounded, and entries that do not fit are counted
+AUDIT_QUEUE_SIZE = 10000
+audit_queue = queue.Queue(maxsize=AUDIT_QUEUE_SIZE)
+AUDIT_BATCH_SIZE = 200
+AUDIT_FLUSH_INTERVAL = 0.5
+AUDIT_STOP_TIMEOUT = 10
+audit_writer_thread = None
+audit_writer_lock = threading.Lock()
+audit_writer_stop = threading.Event()
+audit_dropped = 0
+audit_dropped_lock = threading.Lock()
 
 @login_manager.user_loader
 def load_user(user_id):
     db = get_db()
-    user = db.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+    user = db.execute(SQL_USER_BY_ID, (user_id,)).fetchone()
     if user:
-        return User(user['id'], user['username'], user['role'])
+        # Later get_user_data calls in this request reuse the row
+        g.setdefault('_user_cache', {})[user['id']] = user
+        return User(user['id'], user['username'], user['role'],
+                    user['kra_pin'], user['business_name'])
     return None
 
-def get_db():
-    """Get database connection"""
+class Record(sqlite3.Row):
+    """Row that also answers dict-style .get() lookups"""
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except IndexError:
+            return default
+
+def connect_db(database):
+    """Open and configure a new database connection"""
+    # Pooled connections move between request threads, one at a time
     db = sqlite3.connect(
-        app.config['DATABASE'],
-        detect_types=sqlite3.PARSE_DECLTYPES
+        database,
+        timeout=DB_BUSY_TIMEOUT,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        cached_statements=256,
+        check_same_thread=False
     )
-    db.row_factory = sqlite3.Row
+    db.row_factory = Record
+    
+    # WAL lets readers run alongside a writer; the mode is stored in the
+    # database file, so it only needs setting once per process
+    if database not in wal_databases:
+        db.execute('PRAGMA journal_mode=WAL')
+        wal_databases.add(database)
+    
+    # Per-connection settings; NORMAL sync is durable in WAL mode
+    db.executescript('''
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA mmap_size=268435456;
+        PRAGMA cache_size=-20000;
+    ''')
     return db
 
+def get_db():
+    """Get the database connection for the current app context"""
+    db = getattr(g, '_db', None)
+    if db is None:
+        database = app.config['DATABASE']
+        pool = db_pools.setdefault(database, queue.LifoQueue(maxsize=DB_POOL_SIZE))
+        try:
+            db = pool.get_nowait()
+        except queue.Empty:
+            db = connect_db(database)
+        g._db = db
+        g._db_pool = pool
+    return db
+
+@app.teardown_appcontext
+def close_db(error=None):
+    """Return this app context's connection to the pool"""
+    db = g.pop('_db', None)
+    pool = g.pop('_db_pool', None)
+    if db is None:
+        return
+    try:
+        # Never hand an open transaction to the next request
+        if db.in_transaction:
+            db.rollback()
+        pool.put_nowait(db)
+    except (sqlite3.Error, queue.Full):
+        db.close()
+
+SQL_SCHEMA = '''
+BEGIN IMMEDIATE;
+
+-- Create users table
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    business_name TEXT NOT NULL,
+    kra_pin TEXT NOT NULL UNIQUE,
+    phone_number TEXT NOT NULL,
+    person_in_charge TEXT NOT NULL,
+    town_city TEXT NOT NULL,
+    username TEXT UNIQUE NOT NULL,
+    password_hash TEXT NOT NULL,
+    role TEXT DEFAULT 'admin',
+    is_active BOOLEAN DEFAULT 1,
+    api_key TEXT,
+    receipt_prefix TEXT DEFAULT 'RCP',
+    vat_rate REAL DEFAULT 16.0,
+    include_address BOOLEAN DEFAULT 1,
+    auto_print BOOLEAN DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Create receipts table
+CREATE TABLE IF NOT EXISTS receipts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    receipt_number TEXT UNIQUE NOT NULL,
+    user_id INTEGER NOT NULL,
+    subtotal REAL NOT NULL,
+    vat_amount REAL NOT NULL,
+    total_amount REAL NOT NULL,
+    customer_name TEXT DEFAULT 'Walk-in Customer',
+    customer_pin TEXT DEFAULT '',
+    payment_method TEXT DEFAULT 'Cash',
+    qr_png BLOB,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users (id)
+);
+
+-- Create receipt items table
+CREATE TABLE IF NOT EXISTS receipt_items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    receipt_id INTEGER NOT NULL,
+    product_name TEXT NOT NULL,
+    quantity INTEGER NOT NULL,
+    unit_price REAL NOT NULL,
+    total_price REAL NOT NULL,
+    FOREIGN KEY (receipt_id) REFERENCES receipts (id) ON DELETE CASCADE
+);
+
+-- Create imported receipts table
+CREATE TABLE IF NOT EXISTS imported_receipts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    original_data TEXT NOT NULL,
+    total_amount REAL NOT NULL,
+    vat_amount REAL NOT NULL,
+    receipt_number TEXT NOT NULL,
+    qr_code TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users (id)
+);
+
+-- Audit logs table
+CREATE TABLE IF NOT EXISTS audit_logs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    action TEXT NOT NULL,
+    details TEXT,
+    ip_address TEXT,
+    user_agent TEXT,
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users (id)
+);
+
+-- Per-user receipt numbering, seeded from existing receipts
+CREATE TABLE IF NOT EXISTS user_counters (
+    user_id INTEGER PRIMARY KEY,
+    next_receipt INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY (user_id) REFERENCES users (id)
+);
+INSERT OR IGNORE INTO user_counters (user_id, next_receipt)
+SELECT user_id, COUNT(*) FROM receipts GROUP BY user_id;
+
+-- Per-user imported receipt numbering, seeded the same way
+CREATE TABLE IF NOT EXISTS import_counters (
+    user_id INTEGER PRIMARY KEY,
+    next_import INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY (user_id) REFERENCES users (id)
+);
+INSERT OR IGNORE INTO import_counters (user_id, next_import)
+SELECT user_id, COUNT(*) FROM imported_receipts GROUP BY user_id;
+
+-- Daily sales rollup for reports
+CREATE TABLE IF NOT EXISTS receipts_daily (
+    user_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    receipt_count INTEGER NOT NULL DEFAULT 0,
+    total_sales REAL NOT NULL DEFAULT 0,
+    total_vat REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, date),
+    FOREIGN KEY (user_id) REFERENCES users (id)
+);
+
+-- Build the rollup from existing receipts when it is first created
+INSERT INTO receipts_daily (user_id, date, receipt_count, total_sales, total_vat)
+SELECT user_id, substr(created_at, 1, 10), COUNT(*), SUM(total_amount), SUM(vat_amount)
+FROM receipts
+WHERE NOT EXISTS (SELECT 1 FROM receipts_daily)
+GROUP BY user_id, substr(created_at, 1, 10);
+
+-- Failed logins per IP for rate limiting, shared by all workers
+CREATE TABLE IF NOT EXISTS login_failures (
+    ip_address TEXT PRIMARY KEY,
+    attempts INTEGER NOT NULL,
+    window_start REAL NOT NULL
+);
+
+-- Index for keyset pagination of the receipts listing
+CREATE INDEX IF NOT EXISTS idx_receipts_user_created_id
+ON receipts (user_id, created_at DESC, id DESC);
+
+-- Index for loading the items of a receipt
+CREATE INDEX IF NOT EXISTS idx_receipt_items_receipt
+ON receipt_items (receipt_id);
+
+-- Index for listing and numbering a user's imported receipts
+CREATE INDEX IF NOT EXISTS idx_imported_user_created
+ON imported_receipts (user_id, created_at DESC);
+
+-- Index for API key authentication of active users
+CREATE INDEX IF NOT EXISTS idx_users_api_key
+ON users (api_key) WHERE is_active = 1;
+
+COMMIT;
+'''
+
 def init_db():
     """Initialize database tables"""
-    with app.app_context():
-        db = get_db()
-        
-        # Create users table
-        db.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                business_name TEXT NOT NULL,
-                kra_pin TEXT NOT NULL UNIQUE,
-                phone_number TEXT NOT NULL,
-                person_in_charge TEXT NOT NULL,
-                town_city TEXT NOT NULL,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                role TEXT DEFAULT 'admin',
-                is_active BOOLEAN DEFAULT 1,
-                api_key TEXT,
-                receipt_prefix TEXT DEFAULT 'RCP',
-                vat_rate REAL DEFAULT 16.0,
-                include_address BOOLEAN DEFAULT 1,
-                auto_print BOOLEAN DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Create receipts table
-        db.execute('''
-            CREATE TABLE IF NOT EXISTS receipts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                receipt_number TEXT UNIQUE NOT NULL,
-                user_id INTEGER NOT NULL,
-                subtotal REAL NOT NULL,
-                vat_amount REAL NOT NULL,
-                total_amount REAL NOT NULL,
-                customer_name TEXT DEFAULT 'Walk-in Customer',
-                customer_pin TEXT DEFAULT '',
-                payment_method TEXT DEFAULT 'Cash',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        # Create receipt items table
-        db.execute('''
-            CREATE TABLE IF NOT EXISTS receipt_items (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                receipt_id INTEGER NOT NULL,
-                product_name TEXT NOT NULL,
-                quantity INTEGER NOT NULL,
-                unit_price REAL NOT NULL,
-                total_price REAL NOT NULL,
-                FOREIGN KEY (receipt_id) REFERENCES receipts (id) ON DELETE CASCADE
-            )
-        ''')
+    # A dedicated connection, so none is left pooled for workers forked
+    # after an import-time init_db (gunicorn --preload)
+    with closing(connect_db(app.config['DATABASE'])) as db:
+        # Create all tables and indexes in a single transaction
+        db.executescript(SQL_SCHEMA)
         
-        # Create imported receipts table
-        db.execute('''
-            CREATE TABLE IF NOT EXISTS imported_receipts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                original_data TEXT NOT NULL,
-                total_amount REAL NOT NULL,
-                vat_amount REAL NOT NULL,
-                receipt_number TEXT NOT NULL,
-                qr_code TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        # Audit logs table
-        db.execute('''
-            CREATE TABLE IF NOT EXISTS audit_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                action TEXT NOT NULL,
-                details TEXT,
-                ip_address TEXT,
-                user_agent TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        # Create default admin user if not exists
-        admin_exists = db.execute('SELECT id FROM users WHERE username = ?', ('admin',)).fetchone()
-        if not admin_exists:
-            db.execute('''
-                INSERT INTO users (business_name, kra_pin, phone_number, person_in_charge, town_city, username, password_hash, role, api_key)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                'Tech Solutions Ltd', 'P051234567M', '+254712345678', 
-                'System Administrator', 'Nairobi', 'admin', 
-                generate_password_hash('password'), 'admin', secrets.token_urlsafe(32)
-            ))
-        
-        db.commit()
+        # Write-locked so concurrent workers cannot both migrate or seed
+        db.execute('BEGIN IMMEDIATE')
+        with db:
+            # Add columns missing from databases created before they were introduced
+            receipt_columns = {column['name'] for column in db.execute('PRAGMA table_info(receipts)')}
+            if 'qr_png' not in receipt_columns:
+                db.execute('ALTER TABLE receipts ADD COLUMN qr_png BLOB')
+            
+            # Create default admin user if not exists
+            admin_exists = db.execute('SELECT id FROM users WHERE username = ?', ('admin',)).fetchone()
+            if not admin_exists:
+                db.execute('''
+                    INSERT INTO users (business_name, kra_pin, phone_number, person_in_charge, town_city, username, password_hash, role, api_key)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    'Tech Solutions Ltd', 'P051234567M', '+254712345678', 
+                    'System Administrator', 'Nairobi', 'admin', 
+                    hash_password('password'), 'admin', secrets.token_urlsafe(32)
+                ))
 
 def get_user_data(user_id):
-    """Get user data from database"""
-    db = get_db()
-    user = db.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-    if user:
-        return dict(user)
-    return None
+    """Get user data from database, memoized for the current request"""
+    user_cache = g.setdefault('_user_cache', {})
+    if user_id not in user_cache:
+        db = get_db()
+        user = db.execute(SQL_USER_BY_ID, (user_id,)).fetchone()
+        user_cache[user_id] = user
+    return user_cache[user_id]
+
+def forget_user_data(user_id):
+    """Drop memoized user data after the users row changes"""
+    g.setdefault('_user_cache', {}).pop(user_id, None)
+
+def receipt_stem(user_data):
+    """Get the receipt number part shared by all of a user's receipts"""
+    # Keyed by prefix as well, so a settings change never serves a stale stem
+    key = (user_data['id'], user_data.get('receipt_prefix', 'RCP'))
+    stem = receipt_stems.get(key)
+    if stem is None:
+        stem = receipt_stems[key] = f"{key[1]}-{key[0]:03d}-"
+    return stem
 
 def log_activity(user_id, action, details=None):
     """Log user activities for audit trail"""
+    queue_activity(user_id, action, details,
+                   request.remote_addr, request.headers.get('User-Agent'))
+
+def queue_activity(user_id, action, details, ip_address, user_agent):
+    """Queue an audit entry; usable outside a request, e.g. from a thread"""
     try:
-        db = get_db()
-        db.execute('''
-            INSERT INTO audit_logs (user_id, action, details, ip_address, user_agent)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, action, json.dumps(details) if details else None, 
-              request.remote_addr, request.headers.get('User-Agent')))
-        db.commit()
+        start_audit_writer()
+        audit_queue.put_nowait((
+            user_id, action, orjson.dumps(details).decode() if details else None,
+            ip_address, user_agent,
+            datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        ))
+    except queue.Full:
+        global audit_dropped
+        with audit_dropped_lock:
+            audit_dropped += 1
     except Exception as e:
         print(f"Failed to log activity: {e}")
 
+def start_audit_writer():
+    """Start the audit writer thread on first use"""
+    global audit_writer_thread
+    if audit_writer_thread is not None:
+        return
+    with audit_writer_lock:
+        if audit_writer_thread is None:
+            audit_writer_thread = threading.Thread(
+                target=audit_writer, args=(app.config['DATABASE'],),
+                name='audit-writer', daemon=True
+            )
+            audit_writer_thread.start()
+            atexit.register(stop_audit_writer, app.config['DATABASE'])
+
+def write_audit_batch(db, batch):
+    """Insert a batch of queued audit entries in one transaction"""
+    try:
+        with db:
+            db.executemany('''
+                INSERT INTO audit_logs (user_id, action, details, ip_address, user_agent, timestamp)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', batch)
+    except sqlite3.IntegrityError:
+        if len(batch) == 1:
+            raise
+        # Write the entries one by one so a single bad entry only loses itself
+        for entry in batch:
+            try:
+                write_audit_batch(db, [entry])
+            except Exception as e:
+                print(f"Failed to log activity: {e}")
+
+def flush_audit_queue(database):
+    """Write out audit entries still queued when the process exits"""
+    batch = []
+    while True:
+        try:
+            batch.append(audit_queue.get_nowait())
+        except queue.Empty:
+            break
+    if not batch:
+        return
+    try:
+        db = sqlite3.connect(database, timeout=5)
+        try:
+            write_audit_batch(db, batch)
+        finally:
+            db.close()
+    except Exception as e:
+        print(f"Failed to write audit logs: {e}")
+
+def stop_audit_writer(database):
+    """Let the writer finish its current batch, then flush what is left"""
+    audit_writer_stop.set()
+    if audit_writer_thread is not None:
+        audit_writer_thread.join(timeout=AUDIT_STOP_TIMEOUT)
+    flush_audit_queue(database)
+    report_dropped_audit()
+
+def report_dropped_audit():
+    """Report audit entries dropped because the queue was full"""
+    global audit_dropped
+    with audit_dropped_lock:
+        dropped, audit_dropped = audit_dropped, 0
+    if dropped:
+        print(f"Dropped {dropped} audit log entries: queue full")
+
+def audit_writer(database):
+    """Drain the audit queue into audit_logs, one commit per batch"""
+    with closing(sqlite3.connect(database, timeout=5)) as db:
+        while not audit_writer_stop.is_set():
+            try:
+                batch = [audit_queue.get(timeout=AUDIT_FLUSH_INTERVAL)]
+            except queue.Empty:
+                continue
+            while len(batch) < AUDIT_BATCH_SIZE:
+                try:
+                    batch.append(audit_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                write_audit_batch(db, batch)
+            except Exception as e:
+                print(f"Failed to write audit logs: {e}")
+            report_dropped_audit()
+            
+            # Only a short batch means the queue ran dry; after a full one,
+            # carry straight on so a backlog drains at write speed
+            if len(batch) < AUDIT_BATCH_SIZE:
+                audit_writer_stop.wait(AUDIT_FLUSH_INTERVAL)
+
 def validate_kra_pin(pin):
     """Validate KRA PIN format"""
     if not pin:
         return False
-    pattern = r'^[A-Z]\d{9}[A-Z]$'
-    return bool(re.match(pattern, pin))
+    return KRA_PIN_PATTERN.match(pin) is not None
 
 def validate_receipt_data(data):
-    """Validate receipt data"""
+    """Validate receipt data, returning its line items and subtotal when valid"""
     if 'items' not in data or not isinstance(data['items'], list):
-        return False, "Invalid or missing items"
+        return False, "Invalid or missing items", None, 0
     
     if len(data['items']) == 0:
-        return False, "At least one item is required"
+        return False, "At least one item is required", None, 0
     
+    # Build (name, quantity, unit_price, total_price) rows while validating so
+    # callers can insert them without walking the items again
+    line_items = []
+    subtotal = 0
     for i, item in enumerate(data['items']):
         if not all(k in item for k in ['name', 'quantity', 'price']):
-            return False, f"Invalid item data at position {i+1}"
+            return False, f"Invalid item data at position {i+1}", None, 0
+        
+        name = item['name']
+        quantity = item['quantity']
+        price = item['price']
         
-        if not item['name'] or not item['name'].strip():
-            return False, f"Item name is required at position {i+1}"
+        if not name or not name.strip():
+            return False, f"Item name is required at position {i+1}", None, 0
         
-        if item['quantity'] <= 0:
-            return False, f"Quantity must be positive at position {i+1}"
+        if quantity <= 0:
+            return False, f"Quantity must be positive at position {i+1}", None, 0
         
-        if item['price'] < 0:
-            return False, f"Price cannot be negative at position {i+1}"
+        if price < 0:
+            return False, f"Price cannot be negative at position {i+1}", None, 0
+        
+        line_total = price * quantity
+        line_items.append((name, quantity, price, line_total))
+        subtotal += line_total
     
     # Validate customer PIN if provided
     if data.get('customer_pin') and not validate_kra_pin(data['customer_pin']):
-        return False, "Invalid customer KRA PIN format"
+        return False, "Invalid customer KRA PIN format", None, 0
+    
+    return True, "Valid", line_items, subtotal
+
+def next_sequence(db, table, column, user_id):
+    """Increment and return a per-user counter in table.column"""
+    if SQLITE_HAS_RETURNING:
+        return db.execute(f'''
+            INSERT INTO {table} (user_id, {column}) VALUES (?, 1)
+            ON CONFLICT (user_id) DO UPDATE SET {column} = {column} + 1
+            RETURNING {column}
+        ''', (user_id,)).fetchone()[0]
+    
+    # SQLite before 3.35 has no RETURNING; callers hold the write lock, so
+    # reading the value back straight after the update is safe
+    db.execute(f'INSERT OR IGNORE INTO {table} (user_id, {column}) VALUES (?, 0)', (user_id,))
+    db.execute(f'UPDATE {table} SET {column} = {column} + 1 WHERE user_id = ?', (user_id,))
+    return db.execute(f'SELECT {column} FROM {table} WHERE user_id = ?', (user_id,)).fetchone()[0]
+
+def next_receipt_sequence(db, user_id):
+    """Reserve the next receipt sequence number for a user"""
+    return next_sequence(db, 'user_counters', 'next_receipt', user_id)
+
+def next_import_sequence(db, user_id):
+    """Reserve the next imported receipt sequence number for a user"""
+    return next_sequence(db, 'import_counters', 'next_import', user_id)
+
+def insert_receipt(db, values):
+    """Insert a receipt row and return its id"""
+    if SQLITE_HAS_RETURNING:
+        return db.execute(SQL_INSERT_RECEIPT + 'RETURNING id', values).fetchone()[0]
+    return db.execute(SQL_INSERT_RECEIPT, values).lastrowid
+
+def insert_receipt_items(db, receipt_id, line_items):
+    """Insert a receipt's line items with multi-row VALUES statements"""
+    rows_per_statement = MAX_SQL_BINDINGS // 5
+    for start in range(0, len(line_items), rows_per_statement):
+        chunk = line_items[start:start + rows_per_statement]
+        params = []
+        for line_item in chunk:
+            params.append(receipt_id)
+            params.extend(line_item)
+        db.execute(SQL_INSERT_RECEIPT_ITEMS.format(', '.join(['(?, ?, ?, ?, ?)'] * len(chunk))),
+                   params)
+
+def record_daily_sales(db, user_id, receipt_id, total_amount, vat_amount):
+    """Add a newly created receipt to the user's daily sales rollup"""
+    db.execute('''
+        INSERT INTO receipts_daily (user_id, date, receipt_count, total_sales, total_vat)
+        VALUES (?, (SELECT substr(created_at, 1, 10) FROM receipts WHERE id = ?), 1, ?, ?)
+        ON CONFLICT (user_id, date) DO UPDATE SET
+            receipt_count = receipt_count + 1,
+            total_sales = total_sales + excluded.total_sales,
+            total_vat = total_vat + excluded.total_vat
+    ''', (user_id, receipt_id, total_amount, vat_amount))
+
+def encode_cursor(direction, created_at, receipt_id):
+    """Encode a receipts pagination position as an opaque URL-safe token"""
+    raw = f"{direction}|{created_at}|{receipt_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(token):
+    """Decode a pagination token into (direction, created_at, id), or None if invalid"""
+    if not token:
+        return None
+    try:
+        direction, created_at, receipt_id = base64.urlsafe_b64decode(token.encode()).decode().split('|')
+        if direction not in ('next', 'prev'):
+            return None
+        return direction, created_at, int(receipt_id)
+    except ValueError:
+        return None
+
+def cached_receipt_count(user_id, key):
+    """Return a still-fresh cached receipt count, or None"""
+    cached = receipt_count_cache.get(user_id, {}).get(key)
+    if cached and time.monotonic() - cached[0] < RECEIPT_COUNT_TTL:
+        return cached[1]
+    return None
+
+def store_receipt_count(user_id, key, count):
+    """Cache a receipt count for the listing filters in key"""
+    now = time.monotonic()
+    with receipt_count_lock:
+        counts = receipt_count_cache.setdefault(user_id, OrderedDict())
+        counts[key] = (now, count)
+        counts.move_to_end(key)
+        
+        # Entries share one TTL, so the expired ones are all at the front
+        while counts:
+            stored_at = next(iter(counts.values()))[0]
+            if now - stored_at < RECEIPT_COUNT_TTL and len(counts) <= RECEIPT_COUNT_CACHE_SIZE:
+                break
+            counts.popitem(last=False)
+
+def count_receipts(user_id, filters, where_clause, params):
+    """Count receipts matching the listing filters, cached briefly per user"""
+    key = tuple(filters)
+    count = cached_receipt_count(user_id, key)
+    if count is not None:
+        return count
     
-    return True, "Valid"
+    db = get_db()
+    count = db.execute(f'SELECT COUNT(*) FROM receipts WHERE {where_clause}', params).fetchone()[0]
+    store_receipt_count(user_id, key, count)
+    return count
+
+def invalidate_receipt_count(user_id):
+    """Drop cached receipt counts after a user's receipts change"""
+    with receipt_count_lock:
+        receipt_count_cache.pop(user_id, None)
+
+def generate_qr_png(payload):
+    """Render a QR code payload to PNG bytes"""
+    qr = segno.make(payload, error='L')
+    buffered = io.BytesIO()
+    # Receipts show the code at 120px; 5px modules still print sharply at
+    # thermal printer resolution and keep the inlined PNG small
+    qr.save(buffered, kind='png', scale=5, border=5, compresslevel=9)
+    return buffered.getvalue()
+
+def hash_password(password):
+    """Hash a password for storage"""
+    return password_hasher.hash(password)
+
+def verify_password(password_hash, password):
+    """Check a password against an argon2 or legacy Werkzeug hash"""
+    if not password_hash.startswith('$argon2'):
+        return check_password_hash(password_hash, password)
+    try:
+        return password_hasher.verify(password_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+def password_needs_rehash(password_hash):
+    """Whether a stored hash predates the current argon2 parameters"""
+    return (not password_hash.startswith('$argon2')
+            or password_hasher.check_needs_rehash(password_hash))
+
+def login_attempt_count(db, ip_address, now):
+    """Count failed logins from an IP in its current rate-limit window"""
+    row = db.execute('''
+        SELECT attempts FROM login_failures
+        WHERE ip_address = ? AND window_start > ?
+    ''', (ip_address, now - LOGIN_ATTEMPT_WINDOW)).fetchone()
+    return row['attempts'] if row else 0
+
+def record_failed_login(db, ip_address, now):
+    """Count a failed login, starting a new window once the old one has expired"""
+    expired = now - LOGIN_ATTEMPT_WINDOW
+    with db:
+        db.execute('''
+            INSERT INTO login_failures (ip_address, attempts, window_start) VALUES (?, 1, ?)
+            ON CONFLICT (ip_address) DO UPDATE SET
+                attempts = CASE WHEN window_start <= ? THEN 1 ELSE attempts + 1 END,
+                window_start = CASE WHEN window_start <= ? THEN excluded.window_start
+                                    ELSE window_start END
+        ''', (ip_address, now, expired, expired))
+        # Drop other IPs whose windows have run out so the table stays small
+        db.execute('DELETE FROM login_failures WHERE window_start <= ?', (expired,))
+
+def clear_failed_logins(db, ip_address):
+    """Forget an IP's failed logins after it signs in"""
+    with db:
+        db.execute('DELETE FROM login_failures WHERE ip_address = ?', (ip_address,))
 
 def api_key_required(f):
     """Decorator for API key authentication"""
@@ -215,13 +769,15 @@ def api_key_required(f):
             return jsonify({'error': 'API key required'}), 401
         
         db = get_db()
-        user = db.execute('SELECT * FROM users WHERE api_key = ? AND is_active = 1', (api_key,)).fetchone()
+        user = db.execute(f'SELECT {USER_COLUMNS} FROM users WHERE api_key = ? AND is_active = 1',
+                          (api_key,)).fetchone()
         
         if not user:
             return jsonify({'error': 'Invalid API key'}), 401
         
-        # Set current user for the request
-        request.user_data = dict(user)
+        # Set current user for the request, and let get_user_data reuse the row
+        request.user_data = user
+        g.setdefault('_user_cache', {})[user['id']] = user
         return f(*args, **kwargs)
     return decorated_function
 
@@ -242,23 +798,17 @@ def dashboard():
     db = get_db()
     user_data = get_user_data(current_user.id)
     
-    # Get today's stats
-    today = datetime.now().strftime('%Y-%m-%d')
+    # Get today's stats as a half-open range so the created_at index applies
+    now = datetime.now()
+    today = now.strftime('%Y-%m-%d')
+    tomorrow = (now + timedelta(days=1)).strftime('%Y-%m-%d')
     
-    today_receipts = db.execute('''
-        SELECT COUNT(*) as count, COALESCE(SUM(total_amount), 0) as total_sales, 
-               COALESCE(SUM(vat_amount), 0) as total_vat 
-        FROM receipts 
-        WHERE DATE(created_at) = ? AND user_id = ?
-    ''', (today, current_user.id)).fetchone()
+    # Today's stats and the five latest receipts come back as JSON from a
+    # single statement
+    dashboard_data = db.execute(SQL_DASHBOARD, (current_user.id, today, tomorrow, current_user.id)).fetchone()
     
-    # Get recent receipts
-    recent_receipts = db.execute('''
-        SELECT * FROM receipts 
-        WHERE user_id = ? 
-        ORDER BY created_at DESC 
-        LIMIT 5
-    ''', (current_user.id,)).fetchall()
+    today_receipts = orjson.loads(dashboard_data['stats'])
+    recent_receipts = orjson.loads(dashboard_data['recent'])
     
     # Log dashboard access
     log_activity(current_user.id, 'DASHBOARD_ACCESS')
@@ -311,7 +861,7 @@ def register():
                 return render_template('register.html')
             
             # Create new user
-            password_hash = generate_password_hash(password)
+            password_hash = hash_password(password)
             api_key = secrets.token_urlsafe(32)
             
             db.execute('''
@@ -339,66 +889,40 @@ def create_receipt():
             data = request.get_json()
             
             # Validate receipt data
-            is_valid, message = validate_receipt_data(data)
+            is_valid, message, line_items, subtotal = validate_receipt_data(data)
             if not is_valid:
                 return jsonify({'success': False, 'error': message}), 400
             
             db = get_db()
             user_data = get_user_data(current_user.id)
             
-            # Generate receipt number
-            receipt_count = db.execute(
-                'SELECT COUNT(*) FROM receipts WHERE user_id = ?', 
-                (current_user.id,)
-            ).fetchone()[0]
-            receipt_prefix = user_data.get('receipt_prefix', 'RCP')
-            receipt_number = f"{receipt_prefix}-{current_user.id:03d}-{(receipt_count + 1):06d}"
-            
             # Calculate totals with configurable VAT rate
             vat_rate = user_data.get('vat_rate', 16.0) / 100
-            subtotal = sum(item['price'] * item['quantity'] for item in data['items'])
             vat_amount = subtotal * vat_rate
             total_amount = subtotal + vat_amount
             
-            # Create receipt
-            cursor = db.execute('''
-                INSERT INTO receipts (receipt_number, user_id, subtotal, vat_amount, total_amount, 
-                                    customer_name, customer_pin, payment_method)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (receipt_number, current_user.id, subtotal, vat_amount, total_amount,
-                 data.get('customer_name', 'Walk-in Customer'), 
-                 data.get('customer_pin', ''), 
-                 data.get('payment_method', 'Cash')))
-            
-            receipt_id = cursor.lastrowid
-            
-            # Add receipt items
-            for item in data['items']:
-                db.execute('''
-                    INSERT INTO receipt_items (receipt_id, product_name, quantity, unit_price, total_price)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (receipt_id, item['name'], item['quantity'], item['price'], item['price'] * item['quantity']))
-            
-            db.commit()
-            
-            # Generate QR code
-            qr_data = {
-                'receipt_number': receipt_number,
-                'business_pin': user_data['kra_pin'],
-                'total_amount': total_amount,
-                'vat_amount': vat_amount,
-                'vat_rate': user_data.get('vat_rate', 16.0),
-                'timestamp': datetime.now().isoformat()
-            }
-            
-            qr = qrcode.QRCode(version=1, box_size=10, border=5)
-            qr.add_data(json.dumps(qr_data))
-            qr.make(fit=True)
+            # Number and create the receipt in one write transaction, so a
+            # failed insert does not use up a receipt number
+            db.execute('BEGIN IMMEDIATE')
+            with db:
+                receipt_sequence = next_receipt_sequence(db, current_user.id)
+                receipt_number = receipt_stem(user_data) + f"{receipt_sequence:06d}"
+                
+                # The QR code is rendered by receipt_qr when first requested
+                receipt_id = insert_receipt(db, (
+                    receipt_number, current_user.id, subtotal, vat_amount, total_amount,
+                    data.get('customer_name', 'Walk-in Customer'), 
+                    data.get('customer_pin', ''), 
+                    data.get('payment_method', 'Cash'),
+                    None
+                ))
+                
+                # Add receipt items
+                insert_receipt_items(db, receipt_id, line_items)
+                
+                record_daily_sales(db, current_user.id, receipt_id, total_amount, vat_amount)
             
-            qr_img = qr.make_image(fill_color="black", back_color="white")
-            buffered = io.BytesIO()
-            qr_img.save(buffered, format="PNG")
-            qr_base64 = base64.b64encode(buffered.getvalue()).decode()
+            invalidate_receipt_count(current_user.id)
             
             # Log receipt creation
             log_activity(current_user.id, 'RECEIPT_CREATED', {
@@ -417,7 +941,7 @@ def create_receipt():
                 'subtotal': subtotal,
                 'vat_amount': vat_amount,
                 'total_amount': total_amount,
-                'qr_code': qr_base64
+                'qr_url': url_for('receipt_qr', receipt_id=receipt_id)
             })
             
         except Exception as e:
@@ -443,10 +967,10 @@ def import_receipt():
                 return redirect(request.url)
             
             if file and file.filename.endswith('.json'):
-                data = json.load(file)
+                data = orjson.loads(file.read())
             elif file and file.filename.endswith('.csv'):
-                # Convert CSV to JSON
-                csv_data = file.stream.read().decode('utf-8')
+                # Convert CSV to JSON, reading rows straight off the upload
+                csv_data = io.TextIOWrapper(file.stream, encoding='utf-8', newline='')
                 data = parse_csv_receipt(csv_data)
             else:
                 flash('Unsupported file format. Please upload JSON or CSV.')
@@ -465,14 +989,21 @@ def import_receipt():
             
             db = get_db()
             user_data = get_user_data(current_user.id)
+            original_data = orjson.dumps(data).decode()
             
-            # Generate receipt number for imported receipt
-            receipt_count = db.execute(
-                'SELECT COUNT(*) FROM imported_receipts WHERE user_id = ?', 
-                (current_user.id,)
-            ).fetchone()[0]
-            receipt_prefix = user_data.get('receipt_prefix', 'RCP')
-            receipt_number = f"IMP-{receipt_prefix}-{current_user.id:03d}-{(receipt_count + 1):06d}"
+            # Number and save the imported receipt in one write transaction;
+            # the QR code is rendered after the lock is released
+            db.execute('BEGIN IMMEDIATE')
+            with db:
+                receipt_sequence = next_import_sequence(db, current_user.id)
+                receipt_number = 'IMP-' + receipt_stem(user_data) + f"{receipt_sequence:06d}"
+                
+                # Save imported receipt
+                import_id = db.execute('''
+                    INSERT INTO imported_receipts (user_id, original_data, total_amount, vat_amount, receipt_number, qr_code)
+                    VALUES (?, ?, ?, ?, ?, NULL)
+                ''', (current_user.id, original_data, total_amount, vat_amount,
+                      receipt_number)).lastrowid
             
             # Generate QR code
             qr_data = {
@@ -485,22 +1016,10 @@ def import_receipt():
                 'imported': True
             }
             
-            qr = qrcode.QRCode(version=1, box_size=10, border=5)
-            qr.add_data(json.dumps(qr_data))
-            qr.make(fit=True)
-            
-            qr_img = qr.make_image(fill_color="black", back_color="white")
-            buffered = io.BytesIO()
-            qr_img.save(buffered, format="PNG")
-            qr_base64 = base64.b64encode(buffered.getvalue()).decode()
-            
-            # Save imported receipt
-            db.execute('''
-                INSERT INTO imported_receipts (user_id, original_data, total_amount, vat_amount, receipt_number, qr_code)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (current_user.id, json.dumps(data), total_amount, vat_amount, receipt_number, qr_base64))
-            
-            db.commit()
+            qr_base64 = base64.b64encode(generate_qr_png(orjson.dumps(qr_data))).decode()
+            with db:
+                db.execute('UPDATE imported_receipts SET qr_code = ? WHERE id = ?',
+                           (qr_base64, import_id))
             
             # Log import
             log_activity(current_user.id, 'RECEIPT_IMPORTED', {
@@ -540,15 +1059,20 @@ def extract_total_amount(data):
     return None
 
 def parse_csv_receipt(csv_data):
-    """Parse CSV receipt data"""
-    reader = csv.DictReader(csv_data.splitlines())
+    """Parse CSV receipt data from an iterable of lines"""
+    # Fields beyond the header go under 'extra' rather than a None key,
+    # which would not serialize as JSON
+    reader = csv.DictReader(csv_data, restkey='extra')
     items = []
     total = 0
     
     for row in reader:
-        if 'total' in row.lower() or 'amount' in row.lower():
+        row_text = ','.join(str(value) for value in row.values() if value).lower()
+        if 'total' in row_text or 'amount' in row_text:
             # This might be a total row
             for key, value in row.items():
+                if not isinstance(key, str) or not isinstance(value, str):
+                    continue
                 if value and any(word in key.lower() for word in ['total', 'amount', 'sum']):
                     try:
                         total = float(value)
@@ -566,7 +1090,8 @@ def parse_csv_receipt(csv_data):
 def view_imported_receipts():
     db = get_db()
     imported_receipts = db.execute('''
-        SELECT * FROM imported_receipts 
+        SELECT id, receipt_number, total_amount, vat_amount, created_at
+        FROM imported_receipts 
         WHERE user_id = ? 
         ORDER BY created_at DESC
     ''', (current_user.id,)).fetchall()
@@ -578,48 +1103,86 @@ def view_imported_receipts():
 def receipts():
     db = get_db()
     
-    page = request.args.get('page', 1, type=int)
+    page = max(request.args.get('page', 1, type=int), 1)
     per_page = 10
-    offset = (page - 1) * per_page
+    cursor = decode_cursor(request.args.get('cursor', ''))
     
     # Get filter parameters
     date_from = request.args.get('date_from', '')
     date_to = request.args.get('date_to', '')
     receipt_search = request.args.get('search', '')
     
-    query = 'SELECT * FROM receipts WHERE user_id = ?'
+    conditions = ['user_id = ?']
     params = [current_user.id]
     
     if date_from:
-        query += ' AND DATE(created_at) >= ?'
+        conditions.append('created_at >= ?')
         params.append(date_from)
     if date_to:
-        query += ' AND DATE(created_at) <= ?'
+        conditions.append("created_at < date(?, '+1 day')")
         params.append(date_to)
     if receipt_search:
-        query += ' AND receipt_number LIKE ?'
+        conditions.append('receipt_number LIKE ?')
         params.append(f'%{receipt_search}%')
     
-    query += ' ORDER BY created_at DESC LIMIT ? OFFSET ?'
-    params.extend([per_page, offset])
+    where_clause = ' AND '.join(conditions)
+    filters = (date_from, date_to, receipt_search)
     
-    receipts_data = db.execute(query, params).fetchall()
+    # The first page has no cursor, so a window count over the same scan gives
+    # the filtered total without a second query
+    count_in_query = cursor is None and cached_receipt_count(current_user.id, filters) is None
+    select_columns = RECEIPT_COLUMNS
+    if count_in_query:
+        select_columns += ', COUNT(*) OVER () AS total_count'
     
-    # Get total count for pagination
-    count_query = 'SELECT COUNT(*) FROM receipts WHERE user_id = ?'
-    count_params = [current_user.id]
+    # Seek from the cursor instead of skipping rows with OFFSET; one extra
+    # row is fetched to tell whether there is another page in that direction
+    query = f'SELECT {select_columns} FROM receipts WHERE {where_clause}'
+    query_params = list(params)
+    direction = 'next'
     
-    if date_from:
-        count_query += ' AND DATE(created_at) >= ?'
-        count_params.append(date_from)
-    if date_to:
-        count_query += ' AND DATE(created_at) <= ?'
-        count_params.append(date_to)
-    if receipt_search:
-        count_query += ' AND receipt_number LIKE ?'
-        count_params.append(f'%{receipt_search}%')
+    if cursor:
+        direction, cursor_created_at, cursor_id = cursor
+        if direction == 'next':
+            query += ' AND (created_at, id) < (?, ?)'
+        else:
+            query += ' AND (created_at, id) > (?, ?)'
+        query_params.extend([cursor_created_at, cursor_id])
+    
+    if direction == 'next':
+        query += ' ORDER BY created_at DESC, id DESC LIMIT ?'
+    else:
+        query += ' ORDER BY created_at ASC, id ASC LIMIT ?'
+    query_params.append(per_page + 1)
+    
+    receipts_data = db.execute(query, query_params).fetchall()
+    has_more = len(receipts_data) > per_page
+    receipts_data = receipts_data[:per_page]
+    
+    if direction == 'next':
+        has_next = has_more
+        has_prev = cursor is not None
+    else:
+        receipts_data.reverse()
+        has_next = True
+        has_prev = has_more
+    
+    next_cursor = None
+    prev_cursor = None
+    if receipts_data:
+        if has_next:
+            last = receipts_data[-1]
+            next_cursor = encode_cursor('next', last['created_at'], last['id'])
+        if has_prev:
+            first = receipts_data[0]
+            prev_cursor = encode_cursor('prev', first['created_at'], first['id'])
     
-    total_count = db.execute(count_query, count_params).fetchone()[0]
+    # Get total count for pagination
+    if count_in_query:
+        total_count = receipts_data[0]['total_count'] if receipts_data else 0
+        store_receipt_count(current_user.id, filters, total_count)
+    else:
+        total_count = count_receipts(current_user.id, filters, where_clause, params)
     
     # Log receipts view
     log_activity(current_user.id, 'RECEIPTS_VIEWED', {
@@ -627,54 +1190,31 @@ def receipts():
     })
     
     user_data = get_user_data(current_user.id)
-    return render_template('receipts.html', 
+    # Stream the page so the browser starts on the layout while rows render
+    return app.response_class(stream_template('receipts.html', 
                          receipts=receipts_data,
                          page=page,
                          per_page=per_page,
                          total_count=total_count,
+                         next_cursor=next_cursor,
+                         prev_cursor=prev_cursor,
                          date_from=date_from,
                          date_to=date_to,
                          search=receipt_search,
-                         user_data=user_data)
+                         user_data=user_data))
 
 @app.route('/receipt/<int:receipt_id>')
 @login_required
 def receipt_detail(receipt_id):
     db = get_db()
     
-    receipt = db.execute('''
-        SELECT * FROM receipts 
-        WHERE id = ? AND user_id = ?
-    ''', (receipt_id, current_user.id)).fetchone()
+    receipt = db.execute(SQL_RECEIPT_BY_ID, (receipt_id, current_user.id)).fetchone()
     
     if not receipt:
         flash('Receipt not found')
         return redirect(url_for('receipts'))
     
-    items = db.execute('''
-        SELECT * FROM receipt_items 
-        WHERE receipt_id = ?
-    ''', (receipt_id,)).fetchall()
-    
-    # Generate QR code for this receipt
-    user_data = get_user_data(current_user.id)
-    qr_data = {
-        'receipt_number': receipt['receipt_number'],
-        'business_pin': user_data['kra_pin'],
-        'total_amount': receipt['total_amount'],
-        'vat_amount': receipt['vat_amount'],
-        'vat_rate': user_data.get('vat_rate', 16.0),
-        'timestamp': receipt['created_at']
-    }
-    
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(json.dumps(qr_data))
-    qr.make(fit=True)
-    
-    qr_img = qr.make_image(fill_color="black", back_color="white")
-    buffered = io.BytesIO()
-    qr_img.save(buffered, format="PNG")
-    qr_base64 = base64.b64encode(buffered.getvalue()).decode()
+    items = db.execute(SQL_RECEIPT_ITEMS, (receipt_id,)).fetchall()
     
     # Log receipt view
     log_activity(current_user.id, 'RECEIPT_VIEWED', {'receipt_id': receipt_id})
@@ -682,8 +1222,46 @@ def receipt_detail(receipt_id):
     return render_template('receipt_detail.html', 
                          receipt=receipt, 
                          items=items, 
-                         qr_code=qr_base64,
-                         user_data=user_data)
+                         business_name=current_user.business_name,
+                         kra_pin=current_user.kra_pin)
+
+@app.route('/qr/<int:receipt_id>.png')
+@login_required
+def receipt_qr(receipt_id):
+    """Serve a receipt's QR code as a long-lived cacheable image"""
+    db = get_db()
+    receipt = db.execute(SQL_RECEIPT_QR, (receipt_id, current_user.id)).fetchone()
+    
+    if not receipt:
+        return 'QR code not found', 404
+    
+    qr_png = receipt['qr_png']
+    if not qr_png:
+        # Render on first view and keep the PNG with the receipt, so later
+        # views and other devices get the same image without re-encoding.
+        # The VAT rate comes from the receipt's own amounts, since the
+        # user's setting may have changed since the sale
+        subtotal = receipt['subtotal']
+        vat_rate = round(receipt['vat_amount'] / subtotal * 100, 2) if subtotal else 0.0
+        qr_data = {
+            'receipt_number': receipt['receipt_number'],
+            'business_pin': current_user.kra_pin,
+            'total_amount': receipt['total_amount'],
+            'vat_amount': receipt['vat_amount'],
+            'vat_rate': vat_rate,
+            'timestamp': str(receipt['created_at'])
+        }
+        qr_png = generate_qr_png(orjson.dumps(qr_data))
+        with db:
+            db.execute('UPDATE receipts SET qr_png = ? WHERE id = ? AND qr_png IS NULL',
+                       (qr_png, receipt_id))
+    
+    # Receipt QR codes never change, so browsers may keep them indefinitely;
+    # they stay private because the image encodes the receipt totals
+    response = send_file(io.BytesIO(qr_png), mimetype='image/png',
+                         etag=receipt['receipt_number'])
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
 
 @app.route('/reports')
 @login_required
@@ -694,27 +1272,26 @@ def reports():
     date_from = request.args.get('date_from', datetime.now().replace(day=1).strftime('%Y-%m-%d'))
     date_to = request.args.get('date_to', datetime.now().strftime('%Y-%m-%d'))
     
-    # Get sales summary
+    # Get sales summary from the daily rollup
     summary = db.execute('''
         SELECT 
-            COUNT(*) as receipt_count,
-            COALESCE(SUM(total_amount), 0) as total_sales,
-            COALESCE(SUM(vat_amount), 0) as total_vat,
-            COALESCE(AVG(total_amount), 0) as avg_receipt
-        FROM receipts 
-        WHERE user_id = ? AND DATE(created_at) BETWEEN ? AND ?
+            COALESCE(SUM(receipt_count), 0) as receipt_count,
+            COALESCE(SUM(total_sales), 0) as total_sales,
+            COALESCE(SUM(total_vat), 0) as total_vat,
+            COALESCE(SUM(total_sales) / SUM(receipt_count), 0) as avg_receipt
+        FROM receipts_daily 
+        WHERE user_id = ? AND date BETWEEN ? AND ?
     ''', (current_user.id, date_from, date_to)).fetchone()
     
     # Get daily sales for chart
     daily_sales = db.execute('''
         SELECT 
-            DATE(created_at) as date,
-            COUNT(*) as receipt_count,
-            COALESCE(SUM(total_amount), 0) as daily_sales,
-            COALESCE(SUM(vat_amount), 0) as daily_vat
-        FROM receipts 
-        WHERE user_id = ? AND DATE(created_at) BETWEEN ? AND ?
-        GROUP BY DATE(created_at)
+            date,
+            receipt_count,
+            total_sales as daily_sales,
+            total_vat as daily_vat
+        FROM receipts_daily 
+        WHERE user_id = ? AND date BETWEEN ? AND ?
         ORDER BY date
     ''', (current_user.id, date_from, date_to)).fetchall()
     
@@ -760,6 +1337,7 @@ def settings():
                     WHERE id = ?
                 ''', update_values)
                 db.commit()
+                forget_user_data(current_user.id)
             
             # Log settings update
             log_activity(current_user.id, 'SETTINGS_UPDATED', {
@@ -801,26 +1379,27 @@ def create_user():
             return jsonify({'success': False, 'error': 'Password must be at least 6 characters'}), 400
         
         db = get_db()
-        
-        # Check if username exists
-        existing_user = db.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
-        if existing_user:
-            return jsonify({'success': False, 'error': 'Username already exists'}), 400
-        
-        # Create new user
-        password_hash = generate_password_hash(password)
+        password_hash = hash_password(password)
         api_key = secrets.token_urlsafe(32)
         
-        db.execute('''
-            INSERT INTO users (business_name, kra_pin, phone_number, person_in_charge, 
-                             town_city, username, password_hash, api_key, role)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            'New Business', 'P000000000A', '+254700000000', 
-            'User', 'Nairobi', username, password_hash, api_key, role
-        ))
-        
-        db.commit()
+        # Check and insert under one write lock so a concurrent request
+        # cannot take the username in between
+        db.execute('BEGIN IMMEDIATE')
+        with db:
+            # Check if username exists
+            existing_user = db.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
+            if existing_user:
+                return jsonify({'success': False, 'error': 'Username already exists'}), 400
+            
+            # Create new user
+            db.execute('''
+                INSERT INTO users (business_name, kra_pin, phone_number, person_in_charge, 
+                                 town_city, username, password_hash, api_key, role)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                'New Business', 'P000000000A', '+254700000000', 
+                'User', 'Nairobi', username, password_hash, api_key, role
+            ))
         
         log_activity(current_user.id, 'USER_CREATED', {'username': username, 'role': role})
         
@@ -839,28 +1418,29 @@ def manage_user(user_id):
         if request.method == 'PUT':
             data = request.get_json()
             
-            updates = []
-            values = []
-            
-            if 'role' in data:
-                updates.append('role = ?')
-                values.append(data['role'])
-            
-            if 'is_active' in data:
-                updates.append('is_active = ?')
-                values.append(data['is_active'])
+            if 'role' in data and 'is_active' in data:
+                query = SQL_UPDATE_USER_ROLE_ACTIVE
+                values = (data['role'], data['is_active'], user_id)
+            elif 'role' in data:
+                query = SQL_UPDATE_USER_ROLE
+                values = (data['role'], user_id)
+            elif 'is_active' in data:
+                query = SQL_UPDATE_USER_ACTIVE
+                values = (data['is_active'], user_id)
+            else:
+                return jsonify({'success': True, 'message': 'No changes to apply'})
             
-            if updates:
-                values.append(user_id)
-                db.execute(f'UPDATE users SET {", ".join(updates)} WHERE id = ?', values)
-                db.commit()
+            with db:
+                db.execute(query, values)
+            forget_user_data(user_id)
             
             log_activity(current_user.id, 'USER_UPDATED', {'user_id': user_id, 'updates': data})
             return jsonify({'success': True, 'message': 'User updated successfully'})
         
         elif request.method == 'DELETE':
-            db.execute('DELETE FROM users WHERE id = ?', (user_id,))
-            db.commit()
+            with db:
+                db.execute('DELETE FROM users WHERE id = ?', (user_id,))
+            forget_user_data(user_id)
             
             log_activity(current_user.id, 'USER_DELETED', {'user_id': user_id})
             return jsonify({'success': True, 'message': 'User deleted successfully'})
@@ -868,6 +1448,39 @@ def manage_user(user_id):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def write_backup(database, backup_file, audit_entry):
+    """Copy the database with SQLite's online backup API"""
+    user_id, ip_address, user_agent = audit_entry
+    partial_file = backup_file + '.part'
+    try:
+        with closing(sqlite3.connect(database, timeout=5)) as source:
+            with closing(sqlite3.connect(partial_file)) as target:
+                # Copy in steps so writers are not locked out for the whole backup
+                source.backup(target, pages=1024)
+        # Only a complete backup ever appears under the final name
+        os.replace(partial_file, backup_file)
+    except Exception as e:
+        print(f"Failed to write backup {backup_file}: {e}")
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
+        queue_activity(user_id, 'BACKUP_FAILED',
+                       {'backup_file': backup_file, 'error': str(e)}, ip_address, user_agent)
+    else:
+        queue_activity(user_id, 'BACKUP_CREATED',
+                       {'backup_file': backup_file}, ip_address, user_agent)
+
+def remove_stale_backups(backup_dir):
+    """Delete partial backups left behind by a process that exited mid-copy"""
+    # A running backup rewrites its .part file at every step, so only files
+    # untouched for a while are abandoned
+    cutoff = time.time() - BACKUP_STALE_AGE
+    for entry in os.scandir(backup_dir):
+        if entry.name.endswith('.part') and entry.stat().st_mtime < cutoff:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
 @app.route('/api/backup')
 @login_required
 def create_backup():
@@ -876,15 +1489,17 @@ def create_backup():
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         backup_dir = 'backups'
         os.makedirs(backup_dir, exist_ok=True)
+        remove_stale_backups(backup_dir)
         
         backup_file = f"{backup_dir}/etr_backup_{timestamp}.db"
         
-        # Copy database file
-        import shutil
-        shutil.copy2(app.config['DATABASE'], backup_file)
-        
-        # Log backup creation
-        log_activity(current_user.id, 'BACKUP_CREATED', {'backup_file': backup_file})
+        # Copy the database in the background so large backups do not hold
+        # up the request; the thread logs BACKUP_CREATED or BACKUP_FAILED
+        audit_entry = (current_user.id, request.remote_addr, request.headers.get('User-Agent'))
+        threading.Thread(
+            target=write_backup, args=(app.config['DATABASE'], backup_file, audit_entry),
+            name='backup-writer', daemon=True
+        ).start()
         
         return jsonify({'success': True, 'backup_file': backup_file, 'timestamp': timestamp})
         
@@ -900,31 +1515,25 @@ def generate_kra_report():
     date_from = request.args.get('date_from', datetime.now().replace(day=1).strftime('%Y-%m-%d'))
     date_to = request.args.get('date_to', datetime.now().strftime('%Y-%m-%d'))
     
-    # Get receipts for period
-    receipts = db.execute('''
-        SELECT * FROM receipts 
-        WHERE user_id = ? AND DATE(created_at) BETWEEN ? AND ?
+    # Get receipts for period, counting each one's items from the index
+    receipts = db.execute(f'''
+        SELECT {RECEIPT_COLUMNS},
+               (SELECT COUNT(*) FROM receipt_items WHERE receipt_id = receipts.id) AS items_count
+        FROM receipts 
+        WHERE user_id = ? AND created_at >= ? AND created_at < date(?, '+1 day')
         ORDER BY created_at
-    ''', (current_user.id, date_from, date_to)).fetchall()
+    ''', (current_user.id, date_from, date_to))
     
     user_data = get_user_data(current_user.id)
     
-    # Format for KRA submission
-    kra_data = {
-        'business_pin': user_data['kra_pin'],
-        'business_name': user_data['business_name'],
-        'period': f"{date_from} to {date_to}",
-        'report_generated': datetime.now().isoformat(),
-        'total_receipts': len(receipts),
-        'total_sales': sum(receipt['total_amount'] for receipt in receipts),
-        'total_vat': sum(receipt['vat_amount'] for receipt in receipts),
-        'receipts': []
-    }
-    
+    # Build the receipt list and the period totals in one pass over the cursor
+    report_receipts = []
+    total_sales = 0
+    total_vat = 0
     for receipt in receipts:
-        items = db.execute('SELECT * FROM receipt_items WHERE receipt_id = ?', (receipt['id'],)).fetchall()
-        
-        kra_data['receipts'].append({
+        total_sales += receipt['total_amount']
+        total_vat += receipt['vat_amount']
+        report_receipts.append({
             'receipt_number': receipt['receipt_number'],
             'date_time': receipt['created_at'],
             'customer_name': receipt['customer_name'],
@@ -932,15 +1541,27 @@ def generate_kra_report():
             'subtotal': receipt['subtotal'],
             'vat_amount': receipt['vat_amount'],
             'total_amount': receipt['total_amount'],
-            'items_count': len(items),
+            'items_count': receipt['items_count'],
             'payment_method': receipt['payment_method']
         })
     
+    # Format for KRA submission
+    kra_data = {
+        'business_pin': user_data['kra_pin'],
+        'business_name': user_data['business_name'],
+        'period': f"{date_from} to {date_to}",
+        'report_generated': datetime.now().isoformat(),
+        'total_receipts': len(report_receipts),
+        'total_sales': total_sales,
+        'total_vat': total_vat,
+        'receipts': report_receipts
+    }
+    
     # Log KRA report generation
     log_activity(current_user.id, 'KRA_REPORT_GENERATED', {
         'date_from': date_from,
         'date_to': date_to,
-        'receipt_count': len(receipts)
+        'receipt_count': len(report_receipts)
     })
     
     return jsonify(kra_data)
@@ -954,47 +1575,43 @@ def api_create_receipt():
         user_data = request.user_data
         
         # Validate receipt data
-        is_valid, message = validate_receipt_data(data)
+        is_valid, message, line_items, subtotal = validate_receipt_data(data)
         if not is_valid:
             return jsonify({'success': False, 'error': message}), 400
         
         db = get_db()
         
-        # Generate receipt number
-        receipt_count = db.execute(
-            'SELECT COUNT(*) FROM receipts WHERE user_id = ?', 
-            (user_data['id'],)
-        ).fetchone()[0]
-        receipt_number = f"{user_data['receipt_prefix']}-{user_data['id']:03d}-{(receipt_count + 1):06d}"
-        
         # Calculate totals
         vat_rate = user_data.get('vat_rate', 16.0) / 100
-        subtotal = sum(item['price'] * item['quantity'] for item in data['items'])
         vat_amount = subtotal * vat_rate
         total_amount = subtotal + vat_amount
         
-        # Create receipt
-        cursor = db.execute('''
-            INSERT INTO receipts (receipt_number, user_id, subtotal, vat_amount, total_amount, 
-                                customer_name, customer_pin, payment_method)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (receipt_number, user_data['id'], subtotal, vat_amount, total_amount,
-             data.get('customer_name', 'Walk-in Customer'), 
-             data.get('customer_pin', ''), 
-             data.get('payment_method', 'Cash')))
-        
-        receipt_id = cursor.lastrowid
-        
-        # Add receipt items
-        for item in data['items']:
-            db.execute('''
-                INSERT INTO receipt_items (receipt_id, product_name, quantity, unit_price, total_price)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (receipt_id, item['name'], item['quantity'], item['price'], item['price'] * item['quantity']))
+        # Number and create the receipt in one write transaction; any error
+        # rolls back the receipt, its items and the reserved number together
+        db.execute('BEGIN IMMEDIATE')
+        with db:
+            # Generate receipt number
+            receipt_sequence = next_receipt_sequence(db, user_data['id'])
+            receipt_number = receipt_stem(user_data) + f"{receipt_sequence:06d}"
+            
+            # Create receipt; the QR code is rendered after the lock is released
+            receipt_id = insert_receipt(db, (
+                receipt_number, user_data['id'], subtotal, vat_amount, total_amount,
+                data.get('customer_name', 'Walk-in Customer'), 
+                data.get('customer_pin', ''), 
+                data.get('payment_method', 'Cash'),
+                None
+            ))
+            
+            # Add receipt items
+            insert_receipt_items(db, receipt_id, line_items)
+            
+            record_daily_sales(db, user_data['id'], receipt_id, total_amount, vat_amount)
         
-        db.commit()
+        invalidate_receipt_count(user_data['id'])
         
-        # Generate QR code
+        # The API returns the QR code at once, so render it now and keep it
+        # with the receipt for later views
         qr_data = {
             'receipt_number': receipt_number,
             'business_pin': user_data['kra_pin'],
@@ -1003,15 +1620,12 @@ def api_create_receipt():
             'vat_rate': user_data.get('vat_rate', 16.0),
             'timestamp': datetime.now().isoformat()
         }
+        qr_png = generate_qr_png(orjson.dumps(qr_data))
+        with db:
+            db.execute('UPDATE receipts SET qr_png = ? WHERE id = ? AND qr_png IS NULL',
+                       (qr_png, receipt_id))
         
-        qr = qrcode.QRCode(version=1, box_size=10, border=5)
-        qr.add_data(json.dumps(qr_data))
-        qr.make(fit=True)
-        
-        qr_img = qr.make_image(fill_color="black", back_color="white")
-        buffered = io.BytesIO()
-        qr_img.save(buffered, format="PNG")
-        qr_base64 = base64.b64encode(buffered.getvalue()).decode()
+        qr_base64 = base64.b64encode(qr_png).decode()
         
         # Log API receipt creation
         log_activity(user_data['id'], 'API_RECEIPT_CREATED', {
@@ -1040,24 +1654,22 @@ def api_create_receipt():
 @login_required
 def api_receipt_detail(receipt_id):
     """API endpoint to get receipt details"""
-    db = get_db()
+    # Plain tuple rows, zipped straight into the response dicts
+    cursor = get_db().cursor()
+    cursor.row_factory = None
     
-    receipt = db.execute('''
-        SELECT * FROM receipts 
-        WHERE id = ? AND user_id = ?
-    ''', (receipt_id, current_user.id)).fetchone()
+    receipt = cursor.execute(SQL_RECEIPT_BY_ID, (receipt_id, current_user.id)).fetchone()
     
     if not receipt:
         return jsonify({'error': 'Receipt not found'}), 404
+    receipt_fields = [column[0] for column in cursor.description]
     
-    items = db.execute('''
-        SELECT * FROM receipt_items 
-        WHERE receipt_id = ?
-    ''', (receipt_id,)).fetchall()
+    items = cursor.execute(SQL_RECEIPT_ITEMS, (receipt_id,)).fetchall()
+    item_fields = [column[0] for column in cursor.description]
     
     return jsonify({
-        'receipt': dict(receipt),
-        'items': [dict(item) for item in items]
+        'receipt': dict(zip(receipt_fields, receipt)),
+        'items': [dict(zip(item_fields, item)) for item in items]
     })
 
 @app.route('/analytics')
@@ -1104,44 +1716,46 @@ def live_stats():
 def login():
     # Rate limiting
     ip_address = request.remote_addr
-    now = datetime.now()
+    now = time.time()
+    db = get_db()
     
-    if ip_address in login_attempts:
-        attempts = login_attempts[ip_address]
-        # Clear old attempts
-        attempts = [attempt for attempt in attempts if now - attempt < timedelta(minutes=5)]
-        if len(attempts) >= 5:
-            flash('Too many login attempts. Please try again in 5 minutes.')
-            return render_template('login.html')
-        login_attempts[ip_address] = attempts
-    else:
-        login_attempts[ip_address] = []
+    failed_attempts = login_attempt_count(db, ip_address, now)
+    if failed_attempts >= LOGIN_ATTEMPT_LIMIT:
+        flash('Too many login attempts. Please try again in 5 minutes.')
+        return render_template('login.html')
     
     if request.method == 'POST':
         username = request.form.get('username')
         password = request.form.get('password')
         
-        db = get_db()
-        user_data = db.execute('SELECT * FROM users WHERE username = ? AND is_active = 1', (username,)).fetchone()
+        user_data = db.execute('''
+            SELECT id, username, role, kra_pin, business_name, password_hash
+            FROM users WHERE username = ? AND is_active = 1
+        ''', (username,)).fetchone()
         
-        if user_data and check_password_hash(user_data['password_hash'], password):
-            user = User(user_data['id'], user_data['username'], user_data['role'])
+        if user_data and verify_password(user_data['password_hash'], password):
+            # Move the stored hash to the current argon2 parameters
+            if password_needs_rehash(user_data['password_hash']):
+                with db:
+                    db.execute('UPDATE users SET password_hash = ? WHERE id = ?',
+                               (hash_password(password), user_data['id']))
+            
+            user = User(user_data['id'], user_data['username'], user_data['role'],
+                        user_data['kra_pin'], user_data['business_name'])
             login_user(user)
             
             # Log successful login
             log_activity(user_data['id'], 'LOGIN_SUCCESS', {'ip_address': ip_address})
             
             # Clear login attempts for this IP
-            if ip_address in login_attempts:
-                del login_attempts[ip_address]
+            if failed_attempts:
+                clear_failed_logins(db, ip_address)
             
             next_page = request.args.get('next')
             return redirect(next_page or url_for('dashboard'))
         else:
             # Log failed login attempt
-            if ip_address not in login_attempts:
-                login_attempts[ip_address] = []
-            login_attempts[ip_address].append(now)
+            record_failed_login(db, ip_address, now)
             
             log_activity(None, 'LOGIN_FAILED', {
                 'username': username,
@@ -221,7 +221,7 @@ document.addEventListener('DOMContentLoaded', function() {
                     </div>
                 </div>
                 <div class="qr-code">
-                    <img src="data:image/png;base64,${result.qr_code}" alt="QR Code" style="width: 120px; height: 120px;">
+                    <img src="${result.qr_url}" alt="QR Code" style="width: 120px; height: 120px;">
                 </div>
                 <div class="receipt-footer">
                     <p>Thank you for your business!</p>
@@ -297,7 +297,10 @@ document.addEventListener('DOMContentLoaded', function() {
                 </html>
             `);
             printWindow.document.close();
-            printWindow.print();
+            // Wait for the QR image to load before printing
+            printWindow.onload = function() {
+                printWindow.print();
+            };
         }
     });
     
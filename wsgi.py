@@ -0,0 +1,14 @@
+"""WSGI entry point for running the ETR system under a production server
+
+    gunicorn -w 4 -k gthread --threads 8 -b 0.0.0.0:5000 wsgi:app
+"""
+import os
+
+from app import app, init_db
+
+# Create necessary directories
+os.makedirs('instance', exist_ok=True)
+os.makedirs('backups', exist_ok=True)
+os.makedirs('logs', exist_ok=True)
+
+init_db()